@@ -12,12 +12,14 @@ def main():
     parser.add_argument("--log_level", type=str, default="WARNING", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
                         help="Set the logging level.")
     parser.add_argument("--keep_segments", action="store_true", help="Keep downloaded segments after merging.")
+    parser.add_argument("--verify_hash", action="store_true",
+                        help="Re-hash previously downloaded segments on resume instead of trusting size/mtime.")
     parser.add_argument("--ffmpeg_options", nargs='*', help="Additional FFmpeg options (space-separated).")
     
     args = parser.parse_args()
 
     log_level = getattr(logging, args.log_level.upper(), logging.WARNING)
-    m3u8_to_mp4(args.m3u8_filename, args.output, args.threads, log_level, args.keep_segments, args.ffmpeg_options)
+    m3u8_to_mp4(args.m3u8_filename, args.output, args.threads, log_level, args.keep_segments, args.ffmpeg_options, args.verify_hash)
 
 if __name__ == "__main__":
     main()
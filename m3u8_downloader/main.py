@@ -1,56 +1,129 @@
 import os
 import requests
 import subprocess
-import time
 import logging
 import re
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from tqdm import tqdm
 import hashlib
 import shutil
 import json
+import tempfile
+
+_ID_RE = re.compile(r'_([^_]+_[0-9]+_[0-9]+)/')
 
 def setup_logging(log_level=logging.WARNING):
     logging.basicConfig(level=log_level, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def extract_segments(m3u8_filename):
+def parse_m3u8(m3u8_filename):
     """
-    Extracts segment URLs from an M3U8 file.
+    Parses an M3U8 file in a single pass.
 
     Parameters:
         m3u8_filename (str): The path to the M3U8 file.
 
     Returns:
-        list: A list of segment URLs.
+        tuple: The extracted video ID (or None if not found) and a list of segment URLs.
     """
+    video_id = None
     segments = []
     base_url = os.path.dirname(m3u8_filename)
-    with open(m3u8_filename, 'r') as file:
-        for line in file:
-            line = line.strip()
-            if line and not line.startswith('#'):
-                if not line.startswith('http'):
-                    line = os.path.join(base_url, line)
-                segments.append(line)
-    return segments
-
-def calculate_file_md5(filename):
+    try:
+        with open(m3u8_filename, 'r') as file:
+            lines = file.read().splitlines()
+    except FileNotFoundError:
+        logging.error(f"The file '{m3u8_filename}' was not found.")
+        return None, []
+
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if video_id is None:
+            match = _ID_RE.search(line)
+            if match:
+                full_match = match.group(1)
+                logging.debug(f"Match found: {full_match}")
+                video_id = '_'.join(full_match.split('_', 2)[:2])
+        if not line.startswith('http'):
+            line = os.path.join(base_url, line)
+        segments.append(line)
+
+    if video_id is None:
+        logging.warning("Could not extract ID from M3U8 file. Using default naming.")
+    return video_id, segments
+
+# Segment integrity is a non-cryptographic use case; BLAKE2b is much faster
+# than MD5 and ships with hashlib. Recorded in segment_info.json so caches
+# written with an older algorithm are simply re-verified once.
+HASH_ALGO = 'blake2b'
+
+def calculate_file_hash(filename):
     """
-    Calculates the MD5 hash of a file.
+    Calculates the integrity hash of a file.
 
     Parameters:
         filename (str): The path to the file.
 
     Returns:
-        str: The MD5 hash of the file.
+        str: The hex digest of the file.
     """
-    hash_md5 = hashlib.md5()
     with open(filename, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+        if hasattr(hashlib, 'file_digest'):
+            # Python 3.11+: the read loop runs in C and releases the GIL,
+            # so parallel verification threads actually scale.
+            return hashlib.file_digest(f, HASH_ALGO).hexdigest()
+        hasher = hashlib.new(HASH_ALGO)
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+        return hasher.hexdigest()
+
+def stat_file(filename):
+    """
+    Stats a file with a single syscall.
+
+    Parameters:
+        filename (str): The path to the file.
+
+    Returns:
+        os.stat_result: The stat result, or None if the file does not exist.
+    """
+    try:
+        return os.stat(filename)
+    except FileNotFoundError:
+        return None
+
+def build_session(pool_size):
+    """
+    Builds a requests session with a connection pool sized for the download threads.
+
+    Parameters:
+        pool_size (int): The number of connections to keep alive in the pool.
+
+    Returns:
+        requests.Session: A session that reuses connections across segment downloads.
+    """
+    session = requests.Session()
+    # pool_block makes a worker wait for a free pooled connection instead of
+    # opening a throwaway one that would be discarded after the response.
+    # The wait is unbounded, so every response taken from this session MUST
+    # be closed on all paths (download_segment does this with a with block);
+    # a leaked response permanently costs a pool slot and enough of them
+    # would deadlock all workers.
+    # Retries keep transient server hiccups from surfacing as failed
+    # segments and from tearing down the warm keep-alive connections.
+    retries = Retry(total=3, backoff_factor=0.5,
+                    status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          pool_block=True, max_retries=retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
-def download_segment(url, output_filename, segment_index, total_segments):
+def download_segment(url, output_filename, segment_index, total_segments, session=None):
     """
     Downloads a video segment from a given URL.
 
@@ -59,56 +132,108 @@ def download_segment(url, output_filename, segment_index, total_segments):
         output_filename (str): The file path to save the downloaded segment.
         segment_index (int): The index of the segment being downloaded (for progress display).
         total_segments (int): The total number of segments to download.
+        session (requests.Session): An optional session to reuse connections across segments.
 
     Returns:
-        str: The MD5 hash of the downloaded segment file if successful, None otherwise.
+        str: The integrity hash of the downloaded segment file if successful, None otherwise.
     """
     try:
-        response = requests.get(url, stream=True, timeout=10)
-        response.raise_for_status()
-        total_size = int(response.headers.get('content-length', 0))
-        block_size = 1024  # 1 Kibibyte
-        
-        mode = 'wb'
-        initial_pos = 0
-        
-        if os.path.exists(output_filename):
-            mode = 'ab'
-            initial_pos = os.path.getsize(output_filename)
-            if initial_pos >= total_size:
+        st = stat_file(output_filename)
+        initial_pos = st.st_size if st else 0
+
+        headers = {'Range': f"bytes={initial_pos}-"} if initial_pos > 0 else None
+        # The with block closes the response on every exit path, releasing
+        # its connection back to the (blocking) pool.
+        with (session or requests).get(url, stream=True, timeout=10, headers=headers) as response:
+            if response.status_code == 416:
+                # The requested range starts at end-of-file: nothing is missing.
                 logging.info(f"Segment {segment_index}/{total_segments} already downloaded.")
-                return calculate_file_md5(output_filename)
-        
-        with open(output_filename, mode) as f, tqdm(
-            desc=f"Segment {segment_index}/{total_segments}",
-            initial=initial_pos,
-            total=total_size,
-            unit='iB',
-            unit_scale=True,
-            unit_divisor=1024,
-            leave=False
-        ) as bar:
-            start_time = time.time()
-            downloaded = initial_pos
-            
-            for data in response.iter_content(block_size):
-                size = f.write(data)
-                downloaded += size
-                bar.update(size)
-                
-                elapsed_time = time.time() - start_time
-                if elapsed_time > 0:
-                    speed = downloaded / elapsed_time / 1024  # KB/s
-                    bar.set_postfix(speed=f"{speed:.2f} KB/s", refresh=False)
-        
-        return calculate_file_md5(output_filename)
-    except requests.RequestException as e:
+                return calculate_file_hash(output_filename)
+            response.raise_for_status()
+
+            block_size = 256 * 1024  # 256 KiB
+
+            if initial_pos > 0 and response.status_code == 206:
+                # Partial content: only the missing tail is transferred.
+                mode = 'ab'
+                # "bytes X-Y/total"; the total may be "*" when unknown.
+                total = response.headers.get('content-range', '').rpartition('/')[2]
+                if total.isdigit():
+                    total_size = int(total)
+                else:
+                    total_size = initial_pos + int(response.headers.get('content-length', 0))
+            else:
+                # Server ignored the Range header; re-download from scratch.
+                mode = 'wb'
+                initial_pos = 0
+                total_size = int(response.headers.get('content-length', 0))
+
+            hasher = hashlib.new(HASH_ALGO)
+            if initial_pos > 0:
+                # Feed the already-downloaded prefix into the hash so the digest
+                # covers the whole file without a second full read afterwards.
+                with open(output_filename, 'rb') as existing:
+                    for chunk in iter(lambda: existing.read(block_size), b""):
+                        hasher.update(chunk)
+
+            logging.debug(f"Downloading segment {segment_index}/{total_segments} "
+                          f"({total_size} bytes, resuming at {initial_pos}).")
+
+            with open(output_filename, mode) as f:
+                # Read into one preallocated buffer instead of letting
+                # iter_content allocate a fresh bytes object per block.
+                response.raw.decode_content = True
+                buf = bytearray(block_size)
+                view = memoryview(buf)
+                while True:
+                    n = response.raw.readinto(buf)
+                    if not n:
+                        break
+                    f.write(view[:n])
+                    hasher.update(view[:n])
+
+            return hasher.hexdigest()
+    except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+        # Reading response.raw directly raises raw urllib3 errors (e.g.
+        # ProtocolError on a dropped connection) that requests would have
+        # wrapped; treat them like any other failed download.
         logging.error(f"Error downloading {url}: {e}")
         if os.path.exists(output_filename):
             os.remove(output_filename)
         return None
 
-def download_segments_in_parallel(segments, output_dir, num_threads=8):
+def load_segment_info(info_filename, log_filename):
+    """
+    Loads resume metadata from the compacted file and the append-only log.
+
+    Parameters:
+        info_filename (str): The path to the compacted segment_info.json file.
+        log_filename (str): The path to the segment_info.jsonl append log.
+
+    Returns:
+        dict: Segment metadata keyed by segment index, with log entries
+        (written by runs that were interrupted before compaction) taking
+        precedence over the compacted file.
+    """
+    segment_info = {}
+    if os.path.exists(info_filename):
+        with open(info_filename, 'r') as f:
+            segment_info = json.load(f)
+    if os.path.exists(log_filename):
+        with open(log_filename, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn write from a killed process; skip it.
+                    continue
+                segment_info[str(entry.pop('index'))] = entry
+    return segment_info
+
+def download_segments_in_parallel(segments, output_dir, num_threads=8, verify_hash=False):
     """
     Downloads video segments in parallel.
 
@@ -116,6 +241,8 @@ def download_segments_in_parallel(segments, output_dir, num_threads=8):
         segments (list): A list of segment URLs to download.
         output_dir (str): The directory to save the downloaded segments.
         num_threads (int): The number of threads to use for downloading.
+        verify_hash (bool): Re-hash previously downloaded segments instead of
+            trusting their recorded size and mtime.
 
     Returns:
         list: A sorted list of tuples containing the segment index and filename of downloaded segments.
@@ -127,67 +254,170 @@ def download_segments_in_parallel(segments, output_dir, num_threads=8):
     skipped_counter = 0
 
     segment_info_file = os.path.join(output_dir, 'segment_info.json')
-    if os.path.exists(segment_info_file):
-        with open(segment_info_file, 'r') as f:
-            segment_info = json.load(f)
-    else:
-        segment_info = {}
+    segment_log_file = os.path.join(output_dir, 'segment_info.jsonl')
+    segment_info = load_segment_info(segment_info_file, segment_log_file)
 
     logging.info(f"Starting download of {total_segments} segments.")
 
-    with tqdm(total=total_segments, desc="Overall Progress", unit='segment') as progress_bar:
+    session = build_session(num_threads)
+
+    with open(segment_log_file, 'a') as log_file, \
+            tqdm(total=total_segments, desc="Overall Progress", unit='segment',
+                 disable=logging.getLogger().getEffectiveLevel() > logging.INFO) as progress_bar:
         with ThreadPoolExecutor(max_workers=num_threads) as executor:
-            future_to_index = {}
+            # Sliding window of pending futures so memory stays O(threads)
+            # instead of O(segments): future -> ('verify'|'download', index).
+            inflight = {}
+            max_inflight = num_threads * 4
+
+            def drain_completed():
+                nonlocal skipped_counter
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    kind, i = inflight.pop(future)
+                    segment_filename = os.path.join(output_dir, f"segment_{i:05d}.ts")
+                    if kind == 'verify':
+                        try:
+                            verified = future.result() == segment_info[str(i)]['hash']
+                        except OSError:
+                            verified = False
+                        if verified:
+                            downloaded_segments.append((i, segment_filename))
+                            skipped_counter += 1
+                            progress_bar.update(1)
+                        else:
+                            # Remove the corrupt file first; otherwise the
+                            # re-download resumes past its bad bytes and
+                            # records their digest as good.
+                            try:
+                                os.remove(segment_filename)
+                            except FileNotFoundError:
+                                pass
+                            inflight[executor.submit(
+                                download_segment, segments[i], segment_filename, i + 1, total_segments, session)] = ('download', i)
+                        continue
+                    try:
+                        digest = future.result()
+                        if digest:
+                            downloaded_segments.append((i, segment_filename))
+                            st = os.stat(segment_filename)
+                            entry = {
+                                'url': segments[i],
+                                'hash': digest,
+                                'algo': HASH_ALGO,
+                                'size': st.st_size,
+                                'mtime': st.st_mtime,
+                            }
+                            segment_info[str(i)] = entry
+                            # One flushed line per segment so resume metadata
+                            # survives if the process is killed mid-run.
+                            log_file.write(json.dumps({'index': i, **entry}) + "\n")
+                            log_file.flush()
+                        else:
+                            logging.error(f"Failed to download segment {i + 1}")
+                    except Exception as e:
+                        logging.error(f"Error processing segment {i + 1}: {e}")
+                    finally:
+                        progress_bar.update(1)
+
             for i, seg in enumerate(segments):
+                while len(inflight) >= max_inflight:
+                    drain_completed()
                 segment_filename = os.path.join(output_dir, f"segment_{i:05d}.ts")
-                if str(i) in segment_info and os.path.exists(segment_filename):
-                    if segment_info[str(i)]['md5'] == calculate_file_md5(segment_filename):
-                        downloaded_segments.append((i, segment_filename))
-                        skipped_counter += 1
-                        progress_bar.update(1)
-                        continue
-                future_to_index[executor.submit(download_segment, seg, segment_filename, i + 1, total_segments)] = i
-            
-            for future in as_completed(future_to_index):
-                segment_index = future_to_index[future]
-                try:
-                    md5 = future.result()
-                    if md5:
-                        segment_filename = os.path.join(output_dir, f"segment_{segment_index:05d}.ts")
-                        downloaded_segments.append((segment_index, segment_filename))
-                        segment_info[str(segment_index)] = {'url': segments[segment_index], 'md5': md5}
-                    else:
-                        logging.error(f"Failed to download segment {segment_index + 1}")
-                except Exception as e:
-                    logging.error(f"Error processing segment {segment_index + 1}: {e}")
-                finally:
-                    progress_bar.update(1)
+                if str(i) in segment_info:
+                    info = segment_info[str(i)]
+                    st = stat_file(segment_filename)
+                    if st is not None:
+                        # A matching (size, mtime) pair means the file is
+                        # untouched since we recorded it; truncation (the
+                        # realistic failure mode) shows up as a size change.
+                        stat_match = (st.st_size == info.get('size')
+                                      and st.st_mtime == info.get('mtime'))
+                        if stat_match and not verify_hash:
+                            downloaded_segments.append((i, segment_filename))
+                            skipped_counter += 1
+                            progress_bar.update(1)
+                            continue
+                        if verify_hash and info.get('algo') == HASH_ALGO:
+                            # Verify on the pool so hashing overlaps with the
+                            # downloads instead of blocking them.
+                            inflight[executor.submit(calculate_file_hash, segment_filename)] = ('verify', i)
+                            continue
+                        # Stale stat (or an entry from an older run with a
+                        # different hash algorithm); remove the file first so
+                        # a full-length modified file cannot satisfy the
+                        # Range resume and get its contents re-recorded.
+                        try:
+                            os.remove(segment_filename)
+                        except FileNotFoundError:
+                            pass
+                inflight[executor.submit(download_segment, seg, segment_filename, i + 1, total_segments, session)] = ('download', i)
+
+            while inflight:
+                drain_completed()
+
+    session.close()
 
+    # Compact the log back into the single JSON file now that the run is done.
     with open(segment_info_file, 'w') as f:
         json.dump(segment_info, f)
+    os.remove(segment_log_file)
 
     logging.info(f"Download completed: {len(downloaded_segments)} segments downloaded, {skipped_counter} segments skipped.")
     return sorted(downloaded_segments, key=lambda x: x[0])
 
+def append_file(dst, src):
+    """
+    Appends the contents of one open binary file to another.
+
+    Parameters:
+        dst (file): The destination file, open for writing.
+        src (file): The source file, open for reading.
+
+    Uses os.sendfile so the bytes move in kernel space where available,
+    falling back to buffered 1 MiB copies otherwise.
+    """
+    if hasattr(os, 'sendfile'):
+        # Flush Python-level buffers before writing through the raw fd.
+        dst.flush()
+        try:
+            remaining = os.fstat(src.fileno()).st_size
+            while remaining > 0:
+                sent = os.sendfile(dst.fileno(), src.fileno(), None, remaining)
+                if sent == 0:
+                    break
+                remaining -= sent
+            return
+        except OSError:
+            # Not supported for this file/filesystem; use the copy loop.
+            pass
+    shutil.copyfileobj(src, dst, length=1 << 20)
+
 def merge_segments_to_mp4(segments, output_file, ffmpeg_options=None):
     """
     Merges video segments into a single MP4 file using FFmpeg.
 
+    MPEG-TS segments can be joined byte-for-byte, so the segments are first
+    concatenated into one temporary .ts file and FFmpeg remuxes that single
+    input, instead of having the concat demuxer parse every segment
+    container. The concat demuxer remains as a fallback if the remux fails.
+
     Parameters:
         segments (list): A list of downloaded segments.
         output_file (str): The filename for the merged output MP4 file.
         ffmpeg_options (list): Additional options for the FFmpeg command.
     """
-    concat_filename = "concat_list.txt"
-    with open(concat_filename, 'w') as concat_file:
+    merged_ts = output_file + ".ts"
+    with open(merged_ts, 'wb') as dst:
         for _, seg in segments:
-            concat_file.write(f"file '{seg}'\n")
+            with open(seg, 'rb') as src:
+                append_file(dst, src)
 
     ffmpeg_command = [
-        "ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", concat_filename,
+        "ffmpeg", "-y", "-i", merged_ts,
         "-c", "copy", "-movflags", "+faststart", output_file
     ]
-    
+
     if ffmpeg_options:
         ffmpeg_command.extend(ffmpeg_options)
 
@@ -196,65 +426,61 @@ def merge_segments_to_mp4(segments, output_file, ffmpeg_options=None):
         logging.info(f"Output saved to: {output_file}")
     except subprocess.CalledProcessError as e:
         logging.error(f"FFmpeg error: {e.stderr}")
+        logging.info("Falling back to the concat demuxer.")
+        merge_segments_with_concat_demuxer(segments, output_file, ffmpeg_options)
     finally:
-        os.remove(concat_filename)
+        os.remove(merged_ts)
 
-def extract_id_from_m3u8(m3u8_filename):
+def merge_segments_with_concat_demuxer(segments, output_file, ffmpeg_options=None):
     """
-    Extracts a unique identifier from an M3U8 file.
+    Merges video segments into a single MP4 file via FFmpeg's concat demuxer.
 
     Parameters:
-        m3u8_filename (str): The path to the M3U8 file.
-
-    Returns:
-        str: The extracted ID or None if not found.
+        segments (list): A list of downloaded segments.
+        output_file (str): The filename for the merged output MP4 file.
+        ffmpeg_options (list): Additional options for the FFmpeg command.
     """
+    payload = ("\n".join(f"file '{seg}'" for _, seg in segments) + "\n").encode()
+    with tempfile.NamedTemporaryFile('wb', suffix='.txt', delete=False) as concat_file:
+        concat_filename = concat_file.name
+        concat_file.write(payload)
+
+    ffmpeg_command = [
+        "ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", concat_filename,
+        "-c", "copy", "-movflags", "+faststart", output_file
+    ]
     
+    if ffmpeg_options:
+        ffmpeg_command.extend(ffmpeg_options)
+
     try:
-        with open(m3u8_filename, 'r') as file:
-            for line in file:
-                if line.strip() and not line.startswith('#'):
-                    print(f"Processing line: {line.strip()}")
-                    match = re.search(r'_([^_]+_[0-9]+_[0-9]+)/', line)
-                    if match:
-                        full_match = match.group(1)
-                        print(f"Match found: {full_match}")
-                        
-                        id_part = full_match.split('_', 2)[:2]
-                        result = '_'.join(id_part)
-                        
-                        return result
-            print("WARNING - No valid lines found for ID extraction.")
-    except FileNotFoundError:
-        print(f"Error: The file '{m3u8_filename}' was not found.")
-    except Exception as e:
-        print(f"An error occurred: {e}")
-    
-    print("WARNING - Could not extract ID from M3U8 file. Using default naming.")
-    return None
+        subprocess.run(ffmpeg_command, check=True, capture_output=True, text=True)
+        logging.info(f"Output saved to: {output_file}")
+    except subprocess.CalledProcessError as e:
+        logging.error(f"FFmpeg error: {e.stderr}")
+    finally:
+        os.remove(concat_filename)
 
-def m3u8_to_mp4(m3u8_filename, output_mp4=None, num_threads=8, log_level=logging.WARNING, keep_segments=True, ffmpeg_options=None):
+def m3u8_to_mp4(m3u8_filename, output_mp4=None, num_threads=8, log_level=logging.WARNING, keep_segments=True, ffmpeg_options=None, verify_hash=False):
     """
     Converts an M3U8 file to an MP4 file by downloading segments and merging them.
     """
     setup_logging(log_level)
-    
-    video_id = extract_id_from_m3u8(m3u8_filename)
+
+    video_id, segments = parse_m3u8(m3u8_filename)
     if not video_id:
-        logging.warning("Could not extract ID from M3U8 file. Using default naming.")
         video_id = "default"
 
     if output_mp4 is None:
         output_mp4 = f"{video_id}.mp4"
 
-    segments = extract_segments(m3u8_filename)
     logging.info(f"Found {len(segments)} segments to download.")
 
     output_dir = os.path.join(os.getcwd(), "tmp", f"m3u8_segments_{video_id}")
     os.makedirs(output_dir, exist_ok=True)
     
     try:
-        downloaded_segments = download_segments_in_parallel(segments, output_dir, num_threads)
+        downloaded_segments = download_segments_in_parallel(segments, output_dir, num_threads, verify_hash)
         merge_segments_to_mp4(downloaded_segments, output_mp4, ffmpeg_options)
     finally:
         if not keep_segments: